@@ -2,14 +2,23 @@ import streamlit as st
 import json
 import os
 import sys
+import html
+import hashlib
+import random
+import threading
+import time
+from functools import lru_cache
 from datetime import datetime, timedelta
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import plotly.express as px
 import plotly.graph_objects as go
-from collections import defaultdict, Counter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import redis
-import pickle
+import orjson
 from dotenv import load_dotenv
 
 # Configuration du chemin pour les imports
@@ -19,27 +28,52 @@ sys.path.insert(0, str(project_root))
 # Charger les variables d'environnement
 load_dotenv()
 
+# En-tête HTML du dashboard (construit une seule fois à l'import)
+HEADER_HTML = """
+<div style="background: linear-gradient(90deg, #667eea 0%, #764ba2 100%); padding: 2rem; border-radius: 10px; margin-bottom: 2rem;">
+    <h1 style="color: white; text-align: center; margin: 0;">📊 Dashboard - Assistant Juridique IA</h1>
+    <p style="color: white; text-align: center; margin: 0.5rem 0 0 0;">Visualisation des conversations et analytics</p>
+</div>
+"""
+
+# Nombre de messages affichés par page dans les listes détaillées
+MESSAGES_PAGE_SIZE = 20
+
+# Durée de fraîcheur (secondes) du DataFrame des messages partagé entre sessions
+MESSAGE_FRAME_TTL = 60
+
+# Clés Redis du DataFrame des messages (Arrow) et du résumé de l'accueil (suffixé par l'empreinte)
+MESSAGE_FRAME_CACHE_KEY = "msg_frame_v3"
+SUMMARY_CACHE_KEY = "dashboard_summary"
+
+# Étoiles pré-calculées par note (0 à 5) et emojis des feedbacks textuels
+STARS = tuple("⭐" * i + "☆" * (5 - i) for i in range(6))
+FEEDBACK_EMOJIS = {"good": "👍", "bad": "👎"}
+
+# Délai (secondes) avant une nouvelle tentative de connexion Redis après un échec
+REDIS_RETRY_DELAY = 30
+
 # Import Firebase
 try:
-    from firebase.firebase_config import db
-    print("✅ Firebase configuré avec succès")
+    from firebase.firebase_config import get_db as get_firebase_db
 except ImportError as e:
     print(f"❌ Erreur import Firebase: {e}")
-    db = None
-
-def init_firebase():
-    """Initialise la connexion Firebase"""
-    try:
-        if not db:
-            st.error("❌ Firebase non disponible. Vérifiez la configuration.")
-            return None
-        return db
-    except Exception as e:
-        st.error(f"❌ Erreur de connexion Firebase: {e}")
-        return None
+    get_firebase_db = None
 
 @st.cache_resource
-def init_redis():
+def get_db():
+    """Client Firestore, initialisé une seule fois par processus
+    
+    Lève une exception en cas d'échec : Streamlit ne la met pas en cache et
+    l'initialisation est retentée au prochain appel.
+    """
+    if get_firebase_db is None:
+        raise RuntimeError("Firebase non disponible. Vérifiez la configuration.")
+    db = get_firebase_db()
+    print("✅ Firebase configuré avec succès")
+    return db
+
+def connect_redis():
     """Initialise la connexion Redis Cloud"""
     try:
         # Configuration Redis Cloud depuis .env
@@ -65,132 +99,497 @@ def init_redis():
         # Redis n'est pas disponible, on continue sans cache
         return None
 
-def get_from_cache(key):
+@st.cache_resource
+def get_redis_state():
+    """État partagé de la connexion Redis (client, prochaine tentative après échec)"""
+    return {'client': None, 'retry_at': 0.0, 'lock': threading.Lock()}
+
+def init_redis():
+    """Connexion Redis partagée ; après un échec, pas de nouvelle tentative avant REDIS_RETRY_DELAY"""
+    state = get_redis_state()
+    if state['client'] is not None or time.monotonic() < state['retry_at']:
+        return state['client']
+    
+    # Une seule tentative à la fois : les autres sessions continuent sans cache
+    if not state['lock'].acquire(blocking=False):
+        return None
+    try:
+        if state['client'] is None and time.monotonic() >= state['retry_at']:
+            state['client'] = connect_redis()
+            if state['client'] is None:
+                state['retry_at'] = time.monotonic() + REDIS_RETRY_DELAY
+        return state['client']
+    finally:
+        state['lock'].release()
+
+def get_from_cache(key, redis_client=None):
     """Récupère des données du cache Redis (optionnel)"""
-    redis_client = init_redis()
+    if redis_client is None:
+        redis_client = init_redis()
     if redis_client:
         try:
             data = redis_client.get(key)
             if data:
-                return pickle.loads(data)
+                return orjson.loads(data)
         except Exception as e:
             print(f"Erreur lecture cache: {e}")
     return None
 
-def set_cache(key, data, ttl=300):
+def set_cache(key, data, ttl=300, redis_client=None):
     """Sauvegarde des données dans le cache Redis (TTL en secondes, optionnel)"""
-    redis_client = init_redis()
+    if redis_client is None:
+        redis_client = init_redis()
     if redis_client:
         try:
-            redis_client.setex(key, ttl, pickle.dumps(data))
+            redis_client.setex(key, ttl, orjson.dumps(data))
         except Exception as e:
             print(f"Erreur écriture cache: {e}")
 
-@st.cache_data(ttl=60)
+def delete_cache(*keys, redis_client=None):
+    """Supprime une ou plusieurs entrées du cache Redis en un seul aller-retour (optionnel)"""
+    if redis_client is None:
+        redis_client = init_redis()
+    if redis_client and keys:
+        try:
+            redis_client.delete(*keys)
+        except Exception as e:
+            print(f"Erreur suppression cache: {e}")
+
+def get_frame_from_cache(key, redis_client=None):
+    """Récupère un DataFrame stocké en Arrow IPC dans Redis (optionnel)"""
+    if redis_client is None:
+        redis_client = init_redis()
+    if redis_client:
+        try:
+            data = redis_client.get(key)
+            if data:
+                return pa.ipc.open_stream(pa.BufferReader(data)).read_all().to_pandas()
+        except Exception as e:
+            print(f"Erreur lecture cache: {e}")
+    return None
+
+def set_frame_cache(key, df, ttl=300, redis_client=None):
+    """Sauvegarde un DataFrame en Arrow IPC (colonnaire) dans Redis (optionnel)"""
+    if redis_client is None:
+        redis_client = init_redis()
+    if redis_client:
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            redis_client.setex(key, ttl, sink.getvalue().to_pybytes())
+        except Exception as e:
+            print(f"Erreur écriture cache: {e}")
+
+def stream_paginated(query, page_size=500):
+    """Parcourt une requête Firestore par pages avec curseur (start_after)"""
+    query = query.order_by('__name__').limit(page_size)
+    last_doc = None
+    
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        count = 0
+        for doc in page.stream():
+            count += 1
+            last_doc = doc
+            yield doc
+        
+        if count < page_size:
+            break
+
 def load_conversations_from_firebase():
-    """Charge toutes les conversations depuis Firebase avec cache"""
-    firestore_db = init_firebase()
-    if not firestore_db:
-        return []
+    """Charge toutes les conversations depuis Firebase
     
+    Les erreurs Firestore sont propagées (pas de liste vide) : l'appelant
+    conserve ainsi ses données précédentes en cas d'échec.
+    """
+    firestore_db = get_db()
     conversations = []
     
-    try:
-        conversations_ref = firestore_db.collection('conversations')
-        conversation_docs = conversations_ref.get()
+    conversations_ref = firestore_db.collection('conversations')
+    # Seul le champ 'metadata' des conversations est utilisé ; ces documents
+    # sont lus en parallèle du flux des messages pour recouvrir les attentes réseau
+    executor = ThreadPoolExecutor(max_workers=1)
+    conversations_future = executor.submit(
+        lambda: list(stream_paginated(conversations_ref.select(['metadata'])))
+    )
+    executor.shutdown(wait=False)
+    
+    # Une seule requête collection_group pour tous les messages, regroupés
+    # ensuite par conversation parente (au lieu d'une requête par conversation).
+    # Les réponses, volumineuses, sont chargées à la demande (fetch_responses)
+    messages_query = firestore_db.collection_group('messages').select(
+        ['metadata', 'question', 'feedback', 'docs', 'timestamp']
+    )
+    messages_by_conv = defaultdict(list)
+    for msg_doc in stream_paginated(messages_query):
+        parent_doc = msg_doc.reference.parent.parent
+        if parent_doc is None or parent_doc.parent.id != 'conversations':
+            continue
         
-        for conv_doc in conversation_docs:
-            conv_id = conv_doc.id
-            conv_data = conv_doc.to_dict()
-            
-            metadata = conv_data.get('metadata', {})
-            
-            messages_ref = conversations_ref.document(conv_id).collection('messages')
-            message_docs = messages_ref.get()
-            
-            messages = []
-            for msg_doc in message_docs:
-                msg_data = msg_doc.to_dict()
-                msg_data['id'] = msg_doc.id
-                
-                if 'timestamp' in msg_data and hasattr(msg_data['timestamp'], 'timestamp'):
-                    msg_data['timestamp'] = msg_data['timestamp'].timestamp()
-                
-                messages.append(msg_data)
-            
-            messages.sort(key=lambda x: x.get('timestamp', 0))
-            
-            conversations.append({
-                'id': conv_id,
-                'conversation_id': conv_id,
-                'metadata': metadata,
-                'messages': messages
-            })
+        msg_data = msg_doc.to_dict()
+        msg_data['id'] = msg_doc.id
         
-        return conversations
+        if 'timestamp' in msg_data and hasattr(msg_data['timestamp'], 'timestamp'):
+            msg_data['timestamp'] = msg_data['timestamp'].timestamp()
         
-    except Exception as e:
-        st.error(f"❌ Erreur lors du chargement des conversations: {e}")
-        return []
+        messages_by_conv[parent_doc.id].append(msg_data)
+    
+    for conv_doc in conversations_future.result():
+        conv_id = conv_doc.id
+        conv_data = conv_doc.to_dict()
+        
+        metadata = conv_data.get('metadata', {})
+        
+        messages = messages_by_conv.get(conv_id, [])
+        messages.sort(key=lambda x: x.get('timestamp', 0))
+        
+        conversations.append({
+            'id': conv_id,
+            'conversation_id': conv_id,
+            'metadata': metadata,
+            'messages': messages
+        })
+    
+    return conversations
+
+def build_message_frame(conversations):
+    """Aplatit les conversations en un DataFrame (une ligne par message)"""
+    conv_ids = []
+    messages = []
+    for conv in conversations:
+        conv_id = conv.get('conversation_id', conv.get('id', 'unknown'))
+        for message in conv.get('messages', []):
+            if message:
+                conv_ids.append(conv_id)
+                messages.append(message)
+    
+    # Métadonnées imbriquées aplaties une seule fois (metadata_user_info_user_email, ...)
+    flat = pd.json_normalize(messages, sep='_')
+    
+    def column(name, default):
+        return flat[name] if name in flat.columns else pd.Series(default, index=flat.index, dtype=object)
+    
+    question = column('question', '').fillna('').astype(str)
+    # Seul un user_id numérique égal à 0 est admin (la chaîne "0" ne l'est pas)
+    is_admin = column('metadata_user_info_user_id', 1).map(lambda v: not isinstance(v, str) and v == 0)
+    # Seules les listes de documents sont comptées (tout autre type vaut 0)
+    docs_count = column('docs', None).map(lambda d: len(d) if isinstance(d, list) else 0)
+    user_email = column('metadata_user_info_user_email', '').fillna('').astype(str).str.strip().str.lower()
+    meta_email = column('metadata_email', '').fillna('').astype(str).str.strip().str.lower()
+    
+    df = pd.DataFrame({
+        'conv_id': conv_ids,
+        'msg_id': column('id', '').fillna('').astype(str),
+        # Email normalisé : user_info.user_email, sinon metadata.email
+        'email': user_email.mask(user_email.eq(''), meta_email),
+        'is_admin': is_admin.astype(bool),
+        'has_question': question.str.strip().ne(''),
+        'question': question,
+        'timestamp': pd.to_numeric(column('timestamp', 0.0), errors='coerce').fillna(0.0).astype(float),
+        'docs_count': docs_count.astype(int),
+        'feedback': column('feedback', '').fillna('').astype(str)
+    })
+    
+    # Note extraite une seule fois des feedbacks 'rating_<n>' (0 = pas de note)
+    ratings = df['feedback'].str.extract(r'^rating_([1-5])$', expand=False)
+    df['feedback_rating'] = pd.to_numeric(ratings, errors='coerce').fillna(0).astype('int8')
+    return df
 
-def get_summary_data():
-    """Récupère les données de résumé avec cache Redis"""
-    cache_key = "dashboard_summary"
+def fetch_message_frame(use_cache=True):
+    """Construit le DataFrame des messages (cache Redis Arrow, sinon Firebase)
     
-    # Essayer de récupérer depuis le cache
-    cached_data = get_from_cache(cache_key)
-    if cached_data:
-        return cached_data
+    use_cache=False lit directement Firebase puis réécrit le cache Redis
+    (rafraîchissement périodique).
+    """
+    redis_client = init_redis()
+    
+    if use_cache:
+        df = get_frame_from_cache(MESSAGE_FRAME_CACHE_KEY, redis_client)
+        if df is not None:
+            return df
+    
+    df = build_message_frame(load_conversations_from_firebase())
     
-    # Si pas de cache, récupérer depuis Firebase
-    conversations = load_conversations_from_firebase()
+    # Mettre en cache pour 10 minutes
+    if not df.empty:
+        set_frame_cache(MESSAGE_FRAME_CACHE_KEY, df, 600, redis_client)
     
-    # Vérifier que les conversations sont valides
-    if not conversations:
+    return df
+
+@st.cache_resource
+def get_frame_state():
+    """État partagé du DataFrame des messages (données, empreinte, expiration, rafraîchissement)"""
+    return {
+        'df': None,
+        'digest': None,
+        'expires_at': 0.0,
+        'refreshing': False,
+        'loading': None,  # threading.Event du premier chargement en cours
+        'lock': threading.Lock(),
+    }
+
+def frame_expiry():
+    """Expiration avec gigue pour éviter que toutes les sessions rafraîchissent ensemble"""
+    return time.time() + MESSAGE_FRAME_TTL + random.uniform(0, MESSAGE_FRAME_TTL * 0.2)
+
+def store_message_frame(state, df, digest):
+    """Remplace le DataFrame partagé et son empreinte (appelé sous state['lock'])"""
+    state['df'] = df
+    state['digest'] = digest
+    state['expires_at'] = frame_expiry()
+
+def refresh_message_frame(state):
+    """Recharge le DataFrame en arrière-plan puis remplace la version périmée
+    
+    En cas d'échec, la version périmée est conservée et un nouvel essai a lieu
+    au prochain rerun (pas de contexte Streamlit ici : erreurs via print).
+    """
+    try:
+        df = fetch_message_frame(use_cache=False)
+        digest = compute_frame_digest(df)
+        with state['lock']:
+            # Ne jamais remplacer des données par un résultat vide
+            if df.empty and state['df'] is not None and not state['df'].empty:
+                print("Rafraîchissement des messages ignoré : résultat vide")
+            else:
+                store_message_frame(state, df, digest)
+    except Exception as e:
+        print(f"Erreur rafraîchissement des messages: {e}")
+    finally:
+        with state['lock']:
+            state['refreshing'] = False
+
+def load_message_frame():
+    """DataFrame des messages, servi périmé pendant son rafraîchissement en arrière-plan
+    
+    Partagé par référence entre les sessions : ne pas le modifier en place.
+    """
+    state = get_frame_state()
+    with state['lock']:
+        df = state['df']
+        if df is not None:
+            # Données périmées : un seul rafraîchissement lancé, les sessions continuent
+            if time.time() >= state['expires_at'] and not state['refreshing']:
+                state['refreshing'] = True
+                threading.Thread(target=refresh_message_frame, args=(state,), daemon=True).start()
+            return df
+        
+        # Premier chargement : une seule session interroge Firebase, les autres l'attendent
+        loading = state['loading']
+        is_loader = loading is None
+        if is_loader:
+            loading = state['loading'] = threading.Event()
+    
+    if not is_loader:
+        loading.wait()
+        with state['lock']:
+            df = state['df']
+        if df is None:
+            st.error("❌ Erreur lors du chargement des conversations")
+            return build_message_frame([])
+        return df
+    
+    # Chargement synchrone ; un échec n'est pas conservé (nouvel essai au rerun)
+    try:
+        df = fetch_message_frame()
+        digest = compute_frame_digest(df)
+        with state['lock']:
+            store_message_frame(state, df, digest)
+        return df
+    except Exception as e:
+        st.error(f"❌ Erreur lors du chargement des conversations: {e}")
+        return build_message_frame([])
+    finally:
+        # Réveiller les sessions en attente, chargement réussi ou non
+        with state['lock']:
+            state['loading'] = None
+        loading.set()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_responses(message_keys):
+    """Récupère en un seul aller-retour les réponses des messages (conv_id, msg_id) affichés
+    
+    Les erreurs remontent à l'appelant : Streamlit ne met pas un échec en cache.
+    """
+    if not message_keys:
+        return {}
+    
+    firestore_db = get_db()
+    conversations_ref = firestore_db.collection('conversations')
+    refs = [
+        conversations_ref.document(conv_id).collection('messages').document(msg_id)
+        for conv_id, msg_id in message_keys
+    ]
+    return {
+        (doc.reference.parent.parent.id, doc.id): (doc.to_dict() or {}).get('reponse') or ''
+        for doc in firestore_db.get_all(refs, field_paths=['reponse'])
+        if doc.exists
+    }
+
+@st.cache_resource(max_entries=4)
+def load_rating_index(_df, digest):
+    """Messages notés regroupés par note (1-5), pour un accès direct par rating"""
+    df = _df
+    rated = df[df['feedback_rating'].gt(0)]
+    return {int(rating): group for rating, group in rated.groupby('feedback_rating', sort=False)}
+
+@st.cache_resource(max_entries=4)
+def build_email_index(_df, digest):
+    """Index email -> questions de cet email, construit en une seule passe"""
+    questions = _df[_df['has_question'] & _df['email'].ne('')]
+    return {email: group for email, group in questions.groupby('email', sort=False)}
+
+@st.cache_resource(max_entries=32)
+def load_user_conversations(_df, digest, email):
+    """Messages d'un email regroupés par conversation (ordre conservé)"""
+    filtered = build_email_index(_df, digest).get(email)
+    if filtered is None:
         return []
+    # Nombre de messages et de feedbacks calculés avec le regroupement
+    user_messages = [
+        {
+            'conversation_id': conv_id,
+            'messages': group.to_dict('records'),
+            'total': len(group),
+            'fb_count': int(group['feedback'].ne('').sum())
+        }
+        for conv_id, group in filtered.groupby('conv_id', sort=False)
+    ]
+    return user_messages
+
+@st.cache_resource(max_entries=8)
+def build_email_options(_df, digest, empty_label):
+    """Options du sélecteur d'email ("" + emails triés) et libellés affichés, calculés une fois"""
+    emails = sorted(build_email_index(_df, digest))
+    labels = {"": empty_label, **{email: email for email in emails}}
+    return [""] + emails, labels
+
+def apply_filters(df, admin_filter="Tous", selected_email=""):
+    """Questions du DataFrame filtrées par type d'utilisateur et email (masques booléens)"""
+    mask = df['has_question']
+    if admin_filter == "Admin exclusif":
+        mask = mask & df['is_admin']
+    elif admin_filter == "Non admin exclusif":
+        mask = mask & ~df['is_admin']
+    if selected_email:
+        mask = mask & df['email'].eq(selected_email)
+    return df[mask]
+
+def compute_frame_digest(df):
+    """Empreinte du contenu du DataFrame des messages (feedbacks compris)"""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.blake2b(row_hashes.tobytes(), digest_size=16).hexdigest()
+
+def frame_digest(df):
+    """Empreinte du DataFrame des messages
+    
+    Celle du DataFrame partagé est calculée une seule fois, à son remplacement,
+    et conservée dans get_frame_state() ; tout autre DataFrame est haché.
+    """
+    state = get_frame_state()
+    with state['lock']:
+        if state['df'] is df:
+            return state['digest']
+    return compute_frame_digest(df)
+
+def int_histogram(values):
+    """Histogramme d'entiers positifs via np.bincount (valeur -> effectif non nul)"""
+    counts = np.bincount(values.to_numpy(dtype=np.int64))
+    keys = np.flatnonzero(counts)
+    return pd.Series(counts[keys], index=keys)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def compute_aggregates(_df, digest, admin_filter="Tous", selected_email=""):
+    """Calcule en une passe tous les agrégats des onglets Analyse et Feedbacks
+    
+    Le DataFrame n'est pas haché par Streamlit : le cache est indexé par son
+    empreinte et les filtres, appliqués seulement en cas d'absence du cache.
+    """
+    filtered = apply_filters(_df, admin_filter, selected_email)
+    with_docs = int(filtered['docs_count'].gt(0).sum())
+    rating_counts = np.bincount(filtered['feedback_rating'].to_numpy(dtype=np.int64), minlength=6)
+    return {
+        'docs_hist': int_histogram(filtered['docs_count']),
+        'msgs_per_conv': int_histogram(filtered.groupby('conv_id', sort=False).size()),
+        'questions_with_docs': {
+            "Avec documents": with_docs,
+            "Sans documents": len(filtered) - with_docs
+        },
+        'feedback_hist': {str(rating): int(rating_counts[rating]) for rating in range(1, 6)},
+    }
+
+@st.cache_resource(max_entries=4)
+def get_summary_data(_df, digest):
+    """Résumé par email du DataFrame des messages, avec cache Redis indexé par son empreinte
     
-    # Calculer les statistiques de résumé
-    summary_data = []
-    email_stats = {}
+    Ne pas appeler avec le DataFrame vide d'un chargement échoué (il serait mis en cache).
+    """
+    cache_key = f"{SUMMARY_CACHE_KEY}:{digest}"
+    redis_client = init_redis()
     
-    for conv in conversations:
-        messages = conv.get('messages', [])
-        if messages:
-            for message in messages:
-                if message and message.get('question', '').strip():
-                    metadata = message.get('metadata', {})
-                    email = None
-                    
-                    if metadata:
-                        user_info = metadata.get('user_info', {})
-                        if user_info and isinstance(user_info, dict):
-                            email = user_info.get('user_email', '').strip().lower()
-                        if not email:
-                            email = metadata.get('email', '').strip().lower()
-                    
-                    if email:
-                        if email not in email_stats:
-                            email_stats[email] = {'nb_messages': 0, 'nb_conversations': set()}
-                        
-                        email_stats[email]['nb_messages'] += 1
-                        conv_id = conv.get('conversation_id', conv.get('id', 'unknown'))
-                        email_stats[email]['nb_conversations'].add(conv_id)
-    
-    # Convertir en format tableau
-    for email, stats in email_stats.items():
-        summary_data.append({
-            'Mails': email,
-            'nb de messages': stats['nb_messages'],
-            'nb de conversation': len(stats['nb_conversations'])
+    # Essayer de récupérer depuis le cache
+    cached_data = get_from_cache(cache_key, redis_client)
+    if cached_data:
+        return pd.DataFrame(cached_data)
+    
+    # Si pas de cache, partir du DataFrame des messages (une ligne par question avec email)
+    df = _df.loc[_df['has_question'] & _df['email'].ne(''), ['email', 'conv_id']]
+    if df.empty:
+        return pd.DataFrame()
+    
+    summary_df = (
+        df.groupby('email', sort=False)
+        .agg(nb_messages=('conv_id', 'size'), nb_conversations=('conv_id', 'nunique'))
+        .sort_values('nb_messages', ascending=False, kind='stable')  # Trier par nombre de messages décroissant
+        .reset_index()
+        .rename(columns={
+            'email': 'Mails',
+            'nb_messages': 'nb de messages',
+            'nb_conversations': 'nb de conversation'
         })
-    
-    # Trier par nombre de messages décroissant
-    summary_data.sort(key=lambda x: x['nb de messages'], reverse=True)
+    )
     
     # Mettre en cache pour 10 minutes
-    set_cache(cache_key, summary_data, 600)
+    set_cache(cache_key, summary_df.to_dict('records'), 600, redis_client)
     
-    return summary_data
+    return summary_df
+
+@lru_cache(maxsize=2000)
+def render_response_html(reponse):
+    """Bloc HTML d'une réponse (échappée, sauts de ligne conservés), mémorisé par contenu"""
+    escaped = html.escape(reponse).replace('\n', '<br>')
+    return f"<div style='background-color: #f0f2f6; padding: 10px; border-radius: 5px;'>{escaped}</div>"
+
+def render_response_body(reponse):
+    """Affiche le contenu d'une réponse, ou une mention si elle est absente"""
+    if reponse:
+        st.write("💡 **Réponse:**")
+        st.markdown(render_response_html(str(reponse)), unsafe_allow_html=True)
+    else:
+        st.caption("ℹ️ Pas de réponse enregistrée")
+
+def show_response(reponse):
+    """Affiche la réponse d'un message dans un popover, ou une mention si elle est absente"""
+    if reponse:
+        with st.popover("👁️ Voir la réponse", help="Cliquer pour afficher/masquer la réponse"):
+            render_response_body(reponse)
+    else:
+        render_response_body(reponse)
+
+@st.cache_data(max_entries=64)
+def build_pie_chart(values, names, title, color_sequence=None, labels_inside=False):
+    """Construit un camembert Plotly, mis en cache sur ses entrées (tuples)"""
+    fig = px.pie(
+        values=list(values),
+        names=list(names),
+        title=title,
+        color_discrete_sequence=list(color_sequence) if color_sequence else None
+    )
+    if labels_inside:
+        fig.update_traces(textposition='inside', textinfo='percent+label')
+    return fig
 
 def main():
     """Fonction principale du dashboard avec système d'onglets"""
@@ -201,29 +600,39 @@ def main():
     )
     
     # Header avec style
-    st.markdown("""
-    <div style="background: linear-gradient(90deg, #667eea 0%, #764ba2 100%); padding: 2rem; border-radius: 10px; margin-bottom: 2rem;">
-        <h1 style="color: white; text-align: center; margin: 0;">📊 Dashboard - Assistant Juridique IA</h1>
-        <p style="color: white; text-align: center; margin: 0.5rem 0 0 0;">Visualisation des conversations et analytics</p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(HEADER_HTML, unsafe_allow_html=True)
+    
+    # Rafraîchissement manuel des données Firebase
+    if st.sidebar.button("🔄 Rafraîchir les données"):
+        get_frame_state.clear()
+        load_rating_index.clear()
+        build_email_index.clear()
+        load_user_conversations.clear()
+        build_email_options.clear()
+        compute_aggregates.clear()
+        get_summary_data.clear()
+        delete_cache(MESSAGE_FRAME_CACHE_KEY)
+    
+    # Chargement unique des messages, partagé par tous les onglets
+    with st.spinner("🔄 Chargement des conversations..."):
+        df = load_message_frame()
     
     # Système d'onglets
     tab1, tab2, tab3, tab4 = st.tabs(["🏠 Accueil", "📊 Analyse", "👥 Utilisations", "⭐ Feedbacks"])
     
     with tab1:
-        accueil_tab()
+        accueil_tab(df)
     
     with tab2:
-        analyse_tab()
+        analyse_tab(df)
     
     with tab3:
-        utilisations_tab()
+        utilisations_tab(df)
     
     with tab4:
-        feedbacks_tab()
+        feedbacks_tab(df)
 
-def accueil_tab():
+def accueil_tab(df):
     """Onglet Accueil avec tableau simple et cache Redis"""
     st.header("🏠 Tableau de bord principal")
     
@@ -232,50 +641,35 @@ def accueil_tab():
     cache_status = "🟢 Cache Redis actif" if redis_client else "🟡 Cache Redis indisponible"
     st.caption(cache_status)
     
-    with st.spinner("🔄 Chargement des données..."):
-        summary_data = get_summary_data()
+    # Pas de résumé (ni de mise en cache) pour un chargement vide ou échoué
+    summary_df = pd.DataFrame()
+    if not df.empty:
+        with st.spinner("🔄 Chargement des données..."):
+            summary_df = get_summary_data(df, frame_digest(df))
     
-    if summary_data:
-        df = pd.DataFrame(summary_data)
-        st.dataframe(df, use_container_width=True)
+    if not summary_df.empty:
+        st.dataframe(summary_df, use_container_width=True)
         
         # Affichage des métriques globales
+        totals = summary_df[['nb de messages', 'nb de conversation']].sum()
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.metric("📧 Total Emails", len(summary_data))
+            st.metric("📧 Total Emails", len(summary_df))
         with col2:
-            total_messages = sum(row['nb de messages'] for row in summary_data)
-            st.metric("💬 Total Messages", total_messages)
+            st.metric("💬 Total Messages", int(totals['nb de messages']))
         with col3:
-            total_conversations = sum(row['nb de conversation'] for row in summary_data)
-            st.metric("🗣️ Total Conversations", total_conversations)
+            st.metric("🗣️ Total Conversations", int(totals['nb de conversation']))
     else:
         st.warning("⚠️ Aucune donnée trouvée")
 
-def analyse_tab():
+@st.fragment
+def analyse_tab(df):
     """Onglet Analyse avec recherche, filtres et graphiques"""
     st.header("📊 Analyse des données")
     
-    # Charger les emails disponibles pour le filtre
-    conversations = load_conversations_from_firebase()
-    emails = set()
-    if conversations and len(conversations) > 0:
-        for conv in conversations:
-            messages = conv.get('messages', [])
-            if messages:
-                for message in messages:
-                    if message and message.get('question', '').strip():
-                        metadata = message.get('metadata', {})
-                        if metadata:
-                            user_info = metadata.get('user_info', {})
-                            if user_info and isinstance(user_info, dict):
-                                email = user_info.get('user_email', '').strip()
-                                if email:
-                                    emails.add(email)
-                            # Fallback pour d'autres structures de métadonnées
-                            email_fallback = metadata.get('email', '').strip()
-                            if email_fallback:
-                                emails.add(email_fallback)
+    # Emails disponibles pour le filtre
+    email_options, email_labels = build_email_options(df, frame_digest(df), "Tous les emails")
+    nb_emails = len(email_options) - 1
     
     # Contrôles et filtres
     col1, col2 = st.columns(2)
@@ -289,9 +683,9 @@ def analyse_tab():
     with col2:
         selected_email = st.selectbox(
             "📧 Filtrer par email",
-            [""] + sorted(list(emails)) if emails else [""],
-            format_func=lambda x: "Tous les emails" if x == "" else x,
-            help=f"{len(emails)} emails disponibles" if emails else "Aucun email trouvé"
+            email_options,
+            format_func=email_labels.__getitem__,
+            help=f"{nb_emails} emails disponibles" if nb_emails else "Aucun email trouvé"
         )
     
     # Affichage conditionnel basé sur les filtres
@@ -306,84 +700,41 @@ def analyse_tab():
         
         # Charger et filtrer les données
         with st.spinner("🔄 Analyse des données..."):
-            conversations = load_conversations_from_firebase()
-            
-            if conversations:
-                # Données pour les graphiques
-                doc_per_message = []
-                messages_per_conv = []
-                questions_with_docs = {"Avec documents": 0, "Sans documents": 0}
+            if not df.empty:
+                aggregates = compute_aggregates(df, frame_digest(df), admin_filter, selected_email)
                 
-                for conv in conversations:
-                    message_count = 0
-                    for message in conv.get('messages', []):
-                        if message.get('question', '').strip():
-                            metadata = message.get('metadata', {})
-                            user_info = metadata.get('user_info', {})
-                            user_id = user_info.get('user_id', 1)
-                            
-                            if admin_filter == "Admin exclusif" and user_id != 0:
-                                continue
-                            elif admin_filter == "Non admin exclusif" and user_id == 0:
-                                continue
-                            
-                            # Filtre par email
-                            if selected_email:
-                                message_email = None
-                                if metadata:
-                                    if user_info and isinstance(user_info, dict):
-                                        message_email = user_info.get('user_email', '').strip()
-                                    if not message_email:
-                                        message_email = metadata.get('email', '').strip()
-                                
-                                if message_email != selected_email:
-                                    continue
-                            
-                            message_count += 1
-                            
-                            # Compter les documents
-                            docs = message.get('docs', [])
-                            docs_count = len(docs) if docs is not None and isinstance(docs, list) else 0
-                            
-                            if docs_count > 0:
-                                doc_per_message.append(docs_count)
-                                questions_with_docs["Avec documents"] += 1
-                            else:
-                                doc_per_message.append(0)
-                                questions_with_docs["Sans documents"] += 1
-                    
-                    if message_count > 0:
-                        messages_per_conv.append(message_count)
+                # Données pour les graphiques
+                doc_counts = aggregates['docs_hist']
+                msg_counts = aggregates['msgs_per_conv']
+                questions_with_docs = aggregates['questions_with_docs']
                 
                 # Graphiques en secteurs
                 col1, col2, col3 = st.columns(3)
                 
                 with col1:
-                    if doc_per_message:
-                        doc_counts = Counter(doc_per_message)
-                        fig1 = px.pie(
-                            values=list(doc_counts.values()),
-                            names=[f"{k} doc(s)" for k in doc_counts.keys()],
-                            title="📄 Nb de documents par message"
+                    if not doc_counts.empty:
+                        fig1 = build_pie_chart(
+                            tuple(doc_counts.tolist()),
+                            tuple(f"{k} doc(s)" for k in doc_counts.index.tolist()),
+                            "📄 Nb de documents par message"
                         )
                         st.plotly_chart(fig1, use_container_width=True)
                 
                 with col2:
-                    if messages_per_conv:
-                        msg_counts = Counter(messages_per_conv)
-                        fig2 = px.pie(
-                            values=list(msg_counts.values()),
-                            names=[f"{k} message(s)" for k in msg_counts.keys()],
-                            title="💬 Nb de messages par conversation"
+                    if not msg_counts.empty:
+                        fig2 = build_pie_chart(
+                            tuple(msg_counts.tolist()),
+                            tuple(f"{k} message(s)" for k in msg_counts.index.tolist()),
+                            "💬 Nb de messages par conversation"
                         )
                         st.plotly_chart(fig2, use_container_width=True)
                 
                 with col3:
                     if any(questions_with_docs.values()):
-                        fig3 = px.pie(
-                            values=list(questions_with_docs.values()),
-                            names=list(questions_with_docs.keys()),
-                            title="📎 Questions avec/sans documents"
+                        fig3 = build_pie_chart(
+                            tuple(questions_with_docs.values()),
+                            tuple(questions_with_docs.keys()),
+                            "📎 Questions avec/sans documents"
                         )
                         st.plotly_chart(fig3, use_container_width=True)
             else:
@@ -391,29 +742,14 @@ def analyse_tab():
     else:
         st.info("ℹ️ Veuillez sélectionner un type d'utilisateur ou choisir un email pour voir les analyses")
 
-def feedbacks_tab():
+@st.fragment
+def feedbacks_tab(df):
     """Onglet Feedbacks avec camembert des ratings 1-5"""
     st.header("⭐ Analyse des Feedbacks")
     
-    # Charger les emails disponibles
-    conversations = load_conversations_from_firebase()
-    emails = set()
-    if conversations and len(conversations) > 0:
-        for conv in conversations:
-            messages = conv.get('messages', [])
-            if messages:
-                for message in messages:
-                    if message and message.get('question', '').strip():
-                        metadata = message.get('metadata', {})
-                        if metadata:
-                            user_info = metadata.get('user_info', {})
-                            if user_info and isinstance(user_info, dict):
-                                email = user_info.get('user_email', '').strip()
-                                if email:
-                                    emails.add(email)
-                            email_fallback = metadata.get('email', '').strip()
-                            if email_fallback:
-                                emails.add(email_fallback)
+    # Emails disponibles pour le filtre
+    email_options, email_labels = build_email_options(df, frame_digest(df), "Tous les emails")
+    nb_emails = len(email_options) - 1
     
     # Contrôles et filtres
     col1, col2 = st.columns(2)
@@ -428,9 +764,9 @@ def feedbacks_tab():
     with col2:
         selected_email = st.selectbox(
             "📧 Filtrer par email",
-            [""] + sorted(list(emails)) if emails else [""],
-            format_func=lambda x: "Tous les emails" if x == "" else x,
-            help=f"{len(emails)} emails disponibles" if emails else "Aucun email trouvé",
+            email_options,
+            format_func=email_labels.__getitem__,
+            help=f"{nb_emails} emails disponibles" if nb_emails else "Aucun email trouvé",
             key="feedback_email_filter"
         )
     
@@ -446,42 +782,10 @@ def feedbacks_tab():
         
         # Charger et analyser les feedbacks
         with st.spinner("🔄 Analyse des feedbacks..."):
-            feedback_data = {"1": 0, "2": 0, "3": 0, "4": 0, "5": 0}
-            total_feedbacks = 0
-            
-            if conversations:
-                for conv in conversations:
-                    for message in conv.get('messages', []):
-                        if message.get('question', '').strip() and message.get('feedback'):
-                            metadata = message.get('metadata', {})
-                            user_info = metadata.get('user_info', {})
-                            user_id = user_info.get('user_id', 1)
-                            
-                            # Filtre admin
-                            if admin_filter == "Admin exclusif" and user_id != 0:
-                                continue
-                            elif admin_filter == "Non admin exclusif" and user_id == 0:
-                                continue
-                            
-                            # Filtre par email
-                            if selected_email:
-                                message_email = None
-                                if metadata:
-                                    if user_info and isinstance(user_info, dict):
-                                        message_email = user_info.get('user_email', '').strip()
-                                    if not message_email:
-                                        message_email = metadata.get('email', '').strip()
-                                
-                                if message_email != selected_email:
-                                    continue
-                            
-                            # Analyser le feedback
-                            feedback = message.get('feedback', '')
-                            if feedback and isinstance(feedback, str) and feedback.startswith('rating_'):
-                                rating = feedback.replace('rating_', '')
-                                if rating in feedback_data:
-                                    feedback_data[rating] += 1
-                                    total_feedbacks += 1
+            feedback_data = compute_aggregates(
+                df, frame_digest(df), admin_filter, selected_email
+            )['feedback_hist']
+            total_feedbacks = sum(feedback_data.values())
             
             # Affichage des résultats
             if total_feedbacks > 0:
@@ -493,13 +797,13 @@ def feedbacks_tab():
                     counts = [v for v in feedback_data.values() if v > 0]
                     
                     if ratings:
-                        fig = px.pie(
-                            values=counts,
-                            names=[f"{rating} étoile{'s' if rating != '1' else ''}" for rating in ratings],
-                            title=f"⭐ Distribution des Ratings ({total_feedbacks} feedbacks)",
-                            color_discrete_sequence=px.colors.qualitative.Set3
+                        fig = build_pie_chart(
+                            tuple(counts),
+                            tuple(f"{rating} étoile{'s' if rating != '1' else ''}" for rating in ratings),
+                            f"⭐ Distribution des Ratings ({total_feedbacks} feedbacks)",
+                            color_sequence=tuple(px.colors.qualitative.Set3),
+                            labels_inside=True
                         )
-                        fig.update_traces(textposition='inside', textinfo='percent+label')
                         st.plotly_chart(fig, use_container_width=True)
                 
                 with col2:
@@ -517,107 +821,76 @@ def feedbacks_tab():
                         satisfaction = (feedback_data.get('4', 0) + feedback_data.get('5', 0)) / total_feedbacks * 100
                         st.metric("Satisfaction", f"{satisfaction:.1f}%")
                 
-                # Détail par rating avec boutons cliquables
+                # Détail par rating
                 st.subheader("📋 Détail par Rating")
                 
-                # Variables de session pour gérer l'affichage
-                if 'show_messages_for_rating' not in st.session_state:
-                    st.session_state.show_messages_for_rating = None
-                
+                available_ratings = []
                 for rating in ['5', '4', '3', '2', '1']:
                     count = feedback_data.get(rating, 0)
                     if count > 0:
                         percentage = (count / total_feedbacks) * 100
-                        col_rating, col_button = st.columns([3, 1])
-                        
-                        with col_rating:
-                            st.write(f"⭐ {rating} étoile{'s' if rating != '1' else ''}: {count} ({percentage:.1f}%)")
-                        
-                        with col_button:
-                            if st.button(f"Voir messages {rating}⭐", key=f"btn_rating_{rating}"):
-                                if st.session_state.show_messages_for_rating == rating:
-                                    st.session_state.show_messages_for_rating = None
-                                else:
-                                    st.session_state.show_messages_for_rating = rating
+                        st.write(f"⭐ {rating} étoile{'s' if rating != '1' else ''}: {count} ({percentage:.1f}%)")
+                        available_ratings.append(rating)
+                
+                # Un seul widget de sélection au lieu d'un bouton par rating
+                selected_rating = st.radio(
+                    "Voir les messages",
+                    [""] + available_ratings,
+                    format_func=lambda x: "Masquer" if x == "" else f"{x}⭐",
+                    horizontal=True,
+                    key="show_messages_for_rating"
+                )
                 
                 # Affichage des messages filtrés par rating
-                if st.session_state.show_messages_for_rating:
-                    show_messages_by_rating(conversations, st.session_state.show_messages_for_rating, admin_filter, selected_email)
+                if selected_rating:
+                    show_messages_by_rating(df, selected_rating, admin_filter, selected_email)
             
             else:
                 st.warning("⚠️ Aucun feedback trouvé avec les filtres sélectionnés")
     else:
         st.info("ℹ️ Veuillez sélectionner un type d'utilisateur ou choisir un email pour voir les feedbacks")
 
-def show_messages_by_rating(conversations, target_rating, admin_filter="Tous", selected_email=""):
+def show_messages_by_rating(df, target_rating, admin_filter="Tous", selected_email=""):
     """Affiche tous les messages ayant un rating spécifique"""
     st.subheader(f"💬 Messages avec {target_rating} étoile{'s' if target_rating != '1' else ''}")
     
-    matching_messages = []
+    # Seuls les messages de la note demandée sont filtrés
+    rated = load_rating_index(df, frame_digest(df)).get(int(target_rating))
+    matching = None if rated is None else apply_filters(rated, admin_filter, selected_email)
     
-    if conversations:
-        for conv in conversations:
-            conv_id = conv.get('conversation_id', conv.get('id', 'Unknown'))
-            for message in conv.get('messages', []):
-                if message.get('question', '').strip() and message.get('feedback'):
-                    metadata = message.get('metadata', {})
-                    user_info = metadata.get('user_info', {})
-                    user_id = user_info.get('user_id', 1)
-                    
-                    # Filtres admin
-                    if admin_filter == "Admin exclusif" and user_id != 0:
-                        continue
-                    elif admin_filter == "Non admin exclusif" and user_id == 0:
-                        continue
-                    
-                    # Filtre par email
-                    if selected_email:
-                        message_email = None
-                        if metadata:
-                            if user_info and isinstance(user_info, dict):
-                                message_email = user_info.get('user_email', '').strip()
-                            if not message_email:
-                                message_email = metadata.get('email', '').strip()
-                        
-                        if message_email != selected_email:
-                            continue
-                    
-                    # Vérifier le rating
-                    feedback = message.get('feedback', '')
-                    if feedback and isinstance(feedback, str) and feedback.startswith('rating_'):
-                        rating = feedback.replace('rating_', '')
-                        if rating == target_rating:
-                            # Récupérer l'email pour affichage
-                            display_email = "Non spécifié"
-                            if metadata:
-                                if user_info and isinstance(user_info, dict):
-                                    display_email = user_info.get('user_email', 'Non spécifié')
-                                if display_email == "Non spécifié":
-                                    display_email = metadata.get('email', 'Non spécifié')
-                            
-                            matching_messages.append({
-                                'conversation_id': conv_id,
-                                'question': message.get('question', ''),
-                                'reponse': message.get('reponse', ''),
-                                'timestamp': message.get('timestamp', ''),
-                                'email': display_email,
-                                'docs_count': len(message.get('docs', []) or []),
-                                'feedback': feedback
-                            })
-    
-    if matching_messages:
-        st.success(f"✅ {len(matching_messages)} message(s) trouvé(s) avec {target_rating} étoile(s)")
+    if matching is not None and not matching.empty:
+        st.success(f"✅ {len(matching)} message(s) trouvé(s) avec {target_rating} étoile(s)")
         
-        for i, msg in enumerate(matching_messages, 1):
-            with st.expander(f"📧 Message {i} - {msg['email']} (Conv: {msg['conversation_id'][:8]}...)"):
+        # Pagination : seuls les messages de la page courante sont convertis et rendus
+        nb_pages = (len(matching) - 1) // MESSAGES_PAGE_SIZE + 1
+        page = 1
+        if nb_pages > 1:
+            page = st.number_input(
+                f"Page (sur {nb_pages})",
+                min_value=1,
+                max_value=nb_pages,
+                value=1,
+                key=f"rating_page_{target_rating}"
+            )
+        start = (page - 1) * MESSAGES_PAGE_SIZE
+        page_messages = matching.iloc[start:start + MESSAGES_PAGE_SIZE].to_dict('records')
+        
+        # Réponses de la page courante uniquement (None si le chargement a échoué)
+        try:
+            responses = fetch_responses(tuple((msg['conv_id'], msg['msg_id']) for msg in page_messages))
+        except Exception as e:
+            st.error(f"❌ Erreur lors du chargement des réponses: {e}")
+            responses = None
+        
+        for i, msg in enumerate(page_messages, start + 1):
+            with st.expander(f"📧 Message {i} - {msg['email'] or 'Non spécifié'} (Conv: {msg['conv_id'][:8]}...)"):
                 st.write("❓ **Question:**")
                 st.write(msg['question'])
                 
                 # Informations sur le message
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    stars = "⭐" * int(target_rating) + "☆" * (5 - int(target_rating))
-                    st.caption(f"Rating: {stars} ({target_rating}/5)")
+                    st.caption(f"Rating: {STARS[int(target_rating)]} ({target_rating}/5)")
                 with col2:
                     if msg['docs_count'] > 0:
                         st.caption(f"📄 {msg['docs_count']} document(s)")
@@ -626,166 +899,95 @@ def show_messages_by_rating(conversations, target_rating, admin_filter="Tous", s
                         st.caption(f"⏰ {msg['timestamp']}")
                 
                 # Réponse (optionnelle)
-                if msg['reponse']:
-                    if st.button(f"👁️ Voir réponse", key=f"show_resp_{i}"):
-                        st.write("💡 **Réponse:**")
-                        st.markdown(f"<div style='background-color: #f0f2f6; padding: 10px; border-radius: 5px;'>{msg['reponse']}</div>", 
-                                  unsafe_allow_html=True)
-                else:
-                    st.caption("ℹ️ Pas de réponse enregistrée")
+                if responses is not None:
+                    show_response(responses.get((msg['conv_id'], msg['msg_id'])))
     else:
         st.warning(f"⚠️ Aucun message trouvé avec {target_rating} étoile(s)")
 
-def utilisations_tab():
+def format_feedback(rating, feedback):
+    """Libellé court du feedback d'un message (étoiles, emoji ou absence)"""
+    if rating:
+        return f"{STARS[rating]} ({rating}/5)"
+    if feedback:
+        return f"{FEEDBACK_EMOJIS.get(feedback, '💬')} {feedback}"
+    return "💭 Pas de feedback"
+
+@st.fragment
+def render_conversation(conv_data, i, feedback_summary):
+    """Affiche une conversation ; ses widgets ne relancent que ce fragment"""
+    with st.expander(f"💬 Conversation {i}{feedback_summary} (ID: {conv_data['conversation_id']})"):
+        messages = conv_data['messages']
+        
+        # Un seul tableau pour tous les messages au lieu d'une mise en page par message
+        st.dataframe(
+            pd.DataFrame({
+                "❓ Question": [msg['question'] for msg in messages],
+                "📄 Documents": [msg['docs_count'] for msg in messages],
+                "⏰ Timestamp": [msg['timestamp'] or None for msg in messages],
+                "Feedback": [format_feedback(msg['feedback_rating'], msg['feedback']) for msg in messages]
+            }, index=pd.RangeIndex(1, len(messages) + 1, name="Question")),
+            use_container_width=True
+        )
+        
+        # Réponse de la question choisie ; options et clé stables (ids Firestore),
+        # indépendantes de la position de la conversation dans la liste
+        positions = {msg['msg_id']: j for j, msg in enumerate(messages)}
+        selected = st.selectbox(
+            "👁️ Voir la réponse",
+            list(positions),
+            index=None,
+            format_func=lambda msg_id: f"Question {positions[msg_id] + 1}",
+            placeholder="Choisir une question...",
+            key=f"reponse_{conv_data['conversation_id']}"
+        )
+        if selected is not None:
+            msg = messages[positions[selected]]
+            # Seule la réponse de la question choisie est chargée
+            message_key = (msg['conv_id'], msg['msg_id'])
+            try:
+                reponse = fetch_responses((message_key,)).get(message_key)
+            except Exception as e:
+                st.error(f"❌ Erreur lors du chargement de la réponse: {e}")
+                return
+            render_response_body(reponse)
+
+@st.fragment
+def utilisations_tab(df):
     """Onglet Utilisations avec filtre par mail et liste des messages"""
     st.header("👥 Utilisation par utilisateur")
     
-    # Charger les emails disponibles
+    # Emails disponibles
     with st.spinner("🔄 Chargement des emails..."):
-        conversations = load_conversations_from_firebase()
-        
-        emails = set()
-        if conversations and len(conversations) > 0:
-            for conv in conversations:
-                messages = conv.get('messages', [])
-                if messages:
-                    for message in messages:
-                        if message.get('question', '').strip():
-                            metadata = message.get('metadata', {})
-                            if metadata:
-                                user_info = metadata.get('user_info', {})
-                                if user_info and isinstance(user_info, dict):
-                                    email = user_info.get('user_email', '').strip()
-                                    if email:
-                                        emails.add(email)
-                                # Fallback pour d'autres structures de métadonnées
-                                email_fallback = metadata.get('email', '').strip()
-                                if email_fallback:
-                                    emails.add(email_fallback)
+        email_options, email_labels = build_email_options(df, frame_digest(df), "Choisir un email...")
+        nb_emails = len(email_options) - 1
     
     # Debug : afficher combien d'emails ont été trouvés
-    st.info(f"📊 {len(emails)} emails trouvés dans les données")
+    st.info(f"📊 {nb_emails} emails trouvés dans les données")
     
     # Filtre par email
-    if emails:
+    if nb_emails:
         selected_email = st.selectbox(
             "📧 Sélectionner un email",
-            [""] + sorted(list(emails)),
-            format_func=lambda x: "Choisir un email..." if x == "" else x
+            email_options,
+            format_func=email_labels.__getitem__
         )
         
         if selected_email:
             st.info(f"📧 Affichage des messages pour: {selected_email}")
             
-            # Filtrer et afficher les messages
-            user_messages = []
-            
-            if conversations:
-                for conv in conversations:
-                    if not conv:
-                        continue
-                    conv_messages = []
-                    conv_id = conv.get('conversation_id', conv.get('id', 'Unknown'))
-                    
-                    messages = conv.get('messages', [])
-                    if messages:
-                        for message in messages:
-                            if message and message.get('question', '').strip():
-                                metadata = message.get('metadata', {})
-                                email = None
-                                
-                                # Essayer plusieurs façons de récupérer l'email
-                                if metadata:
-                                    user_info = metadata.get('user_info', {})
-                                    if user_info and isinstance(user_info, dict):
-                                        email = user_info.get('user_email', '').strip()
-                                    if not email:
-                                        email = metadata.get('email', '').strip()
-                                
-                                if email and email == selected_email:
-                                    docs = message.get('docs', [])
-                                    docs_count = len(docs) if docs is not None else 0
-                                    feedback = message.get('feedback', '')
-                                    conv_messages.append({
-                                        'question': message.get('question', ''),
-                                        'reponse': message.get('reponse', ''),
-                                        'timestamp': message.get('timestamp', ''),
-                                        'docs_count': docs_count,
-                                        'feedback': feedback
-                                    })
-                
-                    if conv_messages:
-                        user_messages.append({
-                            'conversation_id': conv_id,
-                            'messages': conv_messages
-                        })
+            user_messages = load_user_conversations(df, frame_digest(df), selected_email)
             
             # Affichage des conversations groupées
             if user_messages:
                 for i, conv_data in enumerate(user_messages, 1):
                     # Calculer les statistiques de feedback pour la conversation
-                    total_messages = len(conv_data['messages'])
-                    messages_with_feedback = sum(1 for msg in conv_data['messages'] if msg.get('feedback'))
+                    total_messages = conv_data['total']
+                    messages_with_feedback = conv_data['fb_count']
                     
                     # Créer l'indicateur pour le titre de la conversation
-                    feedback_summary = f" ({messages_with_feedback}/{total_messages} feedbacks)" if messages_with_feedback > 0 else f" (0/{total_messages} feedbacks)"
+                    feedback_summary = f" ({messages_with_feedback}/{total_messages} feedbacks)"
                     
-                    with st.expander(f"💬 Conversation {i}{feedback_summary} (ID: {conv_data['conversation_id']})"):
-                        for j, msg in enumerate(conv_data['messages'], 1):
-                            # Indicateur de feedback dans le titre
-                            feedback_indicator = ""
-                            if msg.get('feedback'):
-                                if msg['feedback'].startswith('rating_'):
-                                    rating = msg['feedback'].replace('rating_', '')
-                                    feedback_indicator = f" ⭐ {rating}/5"
-                                else:
-                                    feedback_indicator = f" 👍 {msg['feedback']}"
-                            
-                            st.subheader(f"Question {j}{feedback_indicator}")
-                            
-                            # Affichage de la question (toujours visible)
-                            st.write("❓ **Question:**")
-                            st.write(msg['question'])
-                            
-                            # Informations complémentaires
-                            col1, col2, col3 = st.columns([1, 1, 2])
-                            with col1:
-                                if msg['docs_count'] > 0:
-                                    st.caption(f"📄 {msg['docs_count']} document(s)")
-                                if msg['timestamp']:
-                                    st.caption(f"⏰ {msg['timestamp']}")
-                            
-                            with col2:
-                                # Affichage détaillé du feedback
-                                if msg.get('feedback'):
-                                    if msg['feedback'].startswith('rating_'):
-                                        rating = int(msg['feedback'].replace('rating_', ''))
-                                        stars = "⭐" * rating + "☆" * (5 - rating)
-                                        st.caption(f"Feedback: {stars} ({rating}/5)")
-                                    else:
-                                        feedback_emoji = "👍" if msg['feedback'] == "good" else "👎" if msg['feedback'] == "bad" else "💬"
-                                        st.caption(f"Feedback: {feedback_emoji} {msg['feedback']}")
-                                else:
-                                    st.caption("💭 Pas de feedback")
-                            
-                            # Toggle pour voir la réponse
-                            with col3:
-                                if msg['reponse']:
-                                    show_response = st.button(
-                                        "👁️ Voir la réponse", 
-                                        key=f"show_response_{i}_{j}",
-                                        help="Cliquer pour afficher/masquer la réponse"
-                                    )
-                                    
-                                    if show_response:
-                                        st.write("💡 **Réponse:**")
-                                        with st.container():
-                                            st.markdown(f"<div style='background-color: #f0f2f6; padding: 10px; border-radius: 5px;'>{msg['reponse']}</div>", 
-                                                      unsafe_allow_html=True)
-                                else:
-                                    st.caption("ℹ️ Pas de réponse enregistrée")
-                            
-                            st.divider()
+                    render_conversation(conv_data, i, feedback_summary)
             else:
                 st.warning(f"⚠️ Aucun message trouvé pour l'email: {selected_email}")
         else:
@@ -3,20 +3,19 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 import os
 import streamlit as st
+from functools import lru_cache
 from pathlib import Path
 
-def initialize_firebase():
-    """Initialise Firebase avec support Streamlit Cloud et développement local"""
-    
-    if firebase_admin._apps:
-        return firestore.client()
+@lru_cache(maxsize=None)
+def load_credentials():
+    """Charge une seule fois le certificat Firebase (secrets Streamlit Cloud, sinon fichier local)"""
     
     try:
         # Essayer d'abord les secrets Streamlit Cloud
         firebase_config = dict(st.secrets['firebase'])
         cred = credentials.Certificate(firebase_config)
-        firebase_admin.initialize_app(cred)
         print("🔥 Firebase initialisé via Streamlit Cloud secrets!")
+        return cred
         
     except (KeyError, AttributeError, FileNotFoundError):
         # Fallback vers le fichier local
@@ -32,10 +31,23 @@ def initialize_firebase():
             )
         
         cred = credentials.Certificate(str(key_path))
-        firebase_admin.initialize_app(cred)
         print("🔥 Firebase initialisé en local!")
+        return cred
+
+def initialize_firebase():
+    """Initialise Firebase avec support Streamlit Cloud et développement local"""
+    
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(load_credentials())
 
     return firestore.client()
 
-# Instance globale du client Firestore
-db = initialize_firebase()
\ No newline at end of file
+# Client Firestore créé au premier usage (pas d'initialisation réseau à l'import)
+_db = None
+
+def get_db():
+    """Retourne le client Firestore, initialisé au premier appel"""
+    global _db
+    if _db is None:
+        _db = initialize_firebase()
+    return _db